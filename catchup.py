@@ -0,0 +1,178 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+
+from telegram import Update
+from telegram.error import TelegramError
+
+from recorder import RecordingQueue
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки при выборке накопившихся обновлений
+FETCH_LIMIT = 100
+
+# Разбор обновлений, накопившихся за время перезапуска или простоя
+class CatchUp:
+    def __init__(self, max_age: float, rate: float):
+        self.max_age = max_age
+        self.rate = rate
+        self.pending = deque()
+        self.stats = {
+            "fetched": 0,
+            "restored": 0,
+            "stale_dropped": 0,
+            "ignored": 0,
+            "collapsed": 0,
+            "backlog": 0,
+            "fed": 0,
+            "remaining": 0,
+            "drain_seconds": None,
+        }
+
+    # Выборка всех ожидающих обновлений с подтверждением их получения
+    async def fetch(self, bot) -> list:
+        updates = []
+        offset = None
+        while True:
+            try:
+                batch = await bot.get_updates(offset=offset, timeout=0, limit=FETCH_LIMIT)
+            except TelegramError as e:
+                logger.warning(f"Ошибка выборки накопившихся обновлений: {e}")
+                break
+            if not batch:
+                break
+            updates.extend(batch)
+            offset = batch[-1].update_id + 1
+
+        self.stats["fetched"] = len(updates)
+        return updates
+
+    # Устаревшие обновления отбрасываются; /start хранит реферальную ссылку, поэтому его оставляем
+    def is_stale(self, update: Update, now: datetime) -> bool:
+        message = update.effective_message
+        if not message or not message.date:
+            return False
+        if message.text and message.text.startswith("/start"):
+            return False
+        return (now - message.date).total_seconds() > self.max_age
+
+    # Обновление, на которое бот отвечает через LLM (текст, не команда)
+    @staticmethod
+    def needs_answer(update: Update) -> bool:
+        message = update.message
+        return bool(message and message.text and not message.text.startswith("/"))
+
+    # Отбор и склейка: устаревшие и неадресованные боту сообщения отбрасываются,
+    # несколько текстов подряд от одного пользователя в одном чате объединяются в один запрос.
+    # Команда или другое обновление того же диалога закрывает группу, чтобы, например,
+    # /clear между сообщениями не стер ответ на них.
+    def prepare(self, updates: list, bot, is_addressed) -> list:
+        now = datetime.now(timezone.utc)
+        unique = {update.update_id: update for update in updates}
+        ordered = [unique[update_id] for update_id in sorted(unique)]
+
+        prepared = []
+        open_groups = {}
+        for update in ordered:
+            if self.is_stale(update, now):
+                self.stats["stale_dropped"] += 1
+                continue
+
+            chat = update.effective_chat
+            user = update.effective_user
+            key = (chat.id if chat else None, user.id if user else None)
+
+            message = update.message
+            if not message or not message.text or message.text.startswith("/"):
+                open_groups.pop(key, None)
+                prepared.append(update)
+                continue
+
+            if not is_addressed(message):
+                self.stats["ignored"] += 1
+                continue
+
+            if key in open_groups:
+                open_groups[key].append(update)
+                self.stats["collapsed"] += 1
+            else:
+                group = [update]
+                open_groups[key] = group
+                prepared.append(group)
+
+        # Склеенное обновление занимает место последнего из своих сообщений
+        backlog = [self.merge(item, bot) if isinstance(item, list) else item for item in prepared]
+        return sorted(backlog, key=lambda update: update.update_id)
+
+    # Объединение сообщений одного диалога в одно обновление
+    def merge(self, updates: list, bot) -> Update:
+        if len(updates) == 1:
+            return updates[0]
+
+        data = updates[-1].to_dict()
+        data["message"]["text"] = "\n".join(update.message.text for update in updates)
+        data["message"].pop("entities", None)
+
+        # Сохраняем ответ на сообщение бота, даже если он был не в последнем сообщении
+        for update in reversed(updates):
+            if update.message.reply_to_message:
+                data["message"]["reply_to_message"] = update.message.reply_to_message.to_dict()
+                break
+
+        return Update.de_json(data, bot)
+
+    async def load(self, bot, restored: list, is_addressed):
+        fetched = await self.fetch(bot)
+        self.add(restored + fetched, bot, is_addressed)
+        self.stats["restored"] += len(restored)
+        logger.info(
+            f"Накопилось обновлений: {len(fetched)} из Telegram, {len(restored)} сохранено при остановке; "
+            f"устаревших {self.stats['stale_dropped']}, не адресовано боту {self.stats['ignored']}, "
+            f"объединено {self.stats['collapsed']}, к обработке {self.stats['backlog']}"
+        )
+
+    # Добавление обновлений в очередь разбора (в том числе переданных предыдущим экземпляром позже)
+    def add(self, updates: list, bot, is_addressed):
+        backlog = self.prepare(updates, bot, is_addressed)
+        self.pending.extend(backlog)
+        self.stats["backlog"] += len(backlog)
+        self.stats["remaining"] = len(self.pending)
+
+    # Постепенная передача накопившихся обновлений в очередь приложения,
+    # не опережая живой трафик: пока is_busy() возвращает True, ждем.
+    # Ограничение скорости касается только сообщений, идущих в LLM; команды,
+    # стикеры, служебные события и т.п. передаются сразу.
+    async def feed(self, application, is_busy):
+        started = time.monotonic()
+        interval = 1 / self.rate if self.rate > 0 else 0
+
+        while self.pending:
+            update = self.pending[0]
+            needs_answer = self.needs_answer(update)
+            while needs_answer and is_busy():
+                await asyncio.sleep(0.2)
+
+            # Накопившиеся обновления уже не живой трафик: в запись трафика их не добавляем
+            self.pending.popleft()
+            queue = application.update_queue
+            if isinstance(queue, RecordingQueue):
+                queue.put_unrecorded(update)
+            else:
+                await queue.put(update)
+            self.stats["fed"] += 1
+            self.stats["remaining"] = len(self.pending)
+            if needs_answer and interval:
+                await asyncio.sleep(interval)
+
+        self.stats["drain_seconds"] = round(time.monotonic() - started, 1)
+        if self.stats["backlog"]:
+            logger.info(f"Накопившиеся обновления переданы в обработку за {self.stats['drain_seconds']} с")
+
+    def remaining(self) -> list:
+        updates = list(self.pending)
+        self.pending.clear()
+        self.stats["remaining"] = 0
+        return updates
@@ -1,6 +1,8 @@
 import sqlite3
 import os
+import json
 import logging
+import time
 from datetime import datetime
 
 # Настройка логгирования
@@ -46,6 +48,43 @@ def init_db():
                 )
             ''')
             
+            # Таблица истории диалогов (переживает перезапуск бота)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_contexts (
+                    chat_id INTEGER,
+                    user_id INTEGER,
+                    history TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, user_id)
+                )
+            ''')
+            
+            # Таблица запущенных экземпляров бота (передача получения обновлений при перезапуске)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_instances (
+                    instance_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    heartbeat REAL NOT NULL
+                )
+            ''')
+            
+            # Таблица обновлений, не обработанных до остановки бота
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pending_updates (
+                    update_id INTEGER PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    saved_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Таблица служебных настроек, которые должны сохраняться между запусками
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_settings (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+            
             conn.commit()
         logger.info("Database initialized successfully")
     except Exception as e:
@@ -142,6 +181,19 @@ def increment_daily_counter(user_id: int, date: str):
     except Exception as e:
         logger.error(f"Error incrementing daily counter: {e}")
 
+def decrement_daily_counter(user_id: int, date: str):
+    """Возврат списанного сообщения (запрос прерван и не получил ответа)"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE daily_counters SET count = count - 1 WHERE user_id = ? AND date = ? AND count > 0",
+                (user_id, date)
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error decrementing daily counter: {e}")
+
 def get_daily_counter(user_id: int, date: str) -> int:
     """Получение счетчика сообщений для пользователя на указанную дату"""
     try:
@@ -174,5 +226,148 @@ def cleanup_old_counters():
     except Exception as e:
         logger.error(f"Error cleaning up old counters: {e}")
 
+def save_conversation_contexts(contexts: dict):
+    """Сохранение истории диалогов: {(chat_id, user_id): [сообщения]}"""
+    if not contexts:
+        return
+    try:
+        now = datetime.utcnow().isoformat()
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                '''INSERT OR REPLACE INTO conversation_contexts
+                (chat_id, user_id, history, updated_at)
+                VALUES (?, ?, ?, ?)''',
+                [
+                    (chat_id, user_id, json.dumps(history, ensure_ascii=False), now)
+                    for (chat_id, user_id), history in contexts.items()
+                ]
+            )
+            conn.commit()
+        logger.info(f"Conversation contexts saved: {len(contexts)}")
+    except Exception as e:
+        logger.error(f"Error saving conversation contexts: {e}")
+
+def get_conversation_context(chat_id: int, user_id: int) -> list:
+    """Получение сохраненной истории диалога"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT history FROM conversation_contexts WHERE chat_id = ? AND user_id = ?",
+                (chat_id, user_id)
+            )
+            result = cursor.fetchone()
+            return json.loads(result[0]) if result else []
+    except Exception as e:
+        logger.error(f"Error getting conversation context: {e}")
+        return []
+
+def has_conversation_context(user_id: int) -> bool:
+    """Есть ли у пользователя сохраненная история диалога в каком-либо чате"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT 1 FROM conversation_contexts WHERE user_id = ? LIMIT 1",
+                (user_id,)
+            )
+            return cursor.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error checking conversation context: {e}")
+        return False
+
+def delete_conversation_context(chat_id: int, user_id: int):
+    """Удаление сохраненной истории диалога"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM conversation_contexts WHERE chat_id = ? AND user_id = ?",
+                (chat_id, user_id)
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error deleting conversation context: {e}")
+
+def save_pending_updates(updates: list):
+    """Сохранение необработанных обновлений (словари Bot API) для следующего запуска"""
+    if not updates:
+        return
+    try:
+        now = datetime.utcnow().isoformat()
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO pending_updates (update_id, payload, saved_at) VALUES (?, ?, ?)",
+                [(update["update_id"], json.dumps(update, ensure_ascii=False), now) for update in updates]
+            )
+            conn.commit()
+        logger.info(f"Pending updates saved: {len(updates)}")
+    except Exception as e:
+        logger.error(f"Error saving pending updates: {e}")
+
+def pop_pending_updates() -> list:
+    """Получение и удаление сохраненных необработанных обновлений"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT payload FROM pending_updates ORDER BY update_id")
+            updates = [json.loads(row[0]) for row in cursor.fetchall()]
+            cursor.execute("DELETE FROM pending_updates")
+            conn.commit()
+            return updates
+    except Exception as e:
+        logger.error(f"Error getting pending updates: {e}")
+        return []
+
+def set_instance_state(instance_id: str, state: str):
+    """Обновление состояния экземпляра бота ('polling' или 'released') и времени последнего сигнала"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO bot_instances (instance_id, state, heartbeat) VALUES (?, ?, ?)",
+                (instance_id, state, time.time())
+            )
+            # Старые записи остановленных или упавших экземпляров больше не нужны
+            cursor.execute(
+                "DELETE FROM bot_instances WHERE heartbeat < ?",
+                (time.time() - 86400,)
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error setting instance state: {e}")
+
+def get_polling_instances(exclude_id: str, stale_after: float) -> list:
+    """Другие экземпляры, которые получают обновления и подавали сигнал не позже stale_after секунд назад"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT instance_id FROM bot_instances WHERE state = 'polling' AND instance_id != ? AND heartbeat > ?",
+                (exclude_id, time.time() - stale_after)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Error getting polling instances: {e}")
+        return []
+
+def get_or_create_setting(name: str, default: str) -> str:
+    """Получение настройки; если ее еще нет, сохраняется default"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO bot_settings (name, value) VALUES (?, ?)",
+                (name, default)
+            )
+            cursor.execute("SELECT value FROM bot_settings WHERE name = ?", (name,))
+            conn.commit()
+            return cursor.fetchone()[0]
+    except Exception as e:
+        logger.error(f"Error getting setting {name}: {e}")
+        return default
+
 # Инициализируем базу данных при импорте модуля
 init_db()
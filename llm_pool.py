@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+import openai
+from openai import OpenAI
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.novita.ai/v3/openai"
+DEFAULT_MODEL = "deepseek/deepseek-r1-0528"
+
+# Окно учета токенов для лимита tokens-per-minute
+USAGE_WINDOW = 60
+
+# Ошибки, при которых запрос повторяется на другом ключе
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# Ошибки ключа (отозван, нет доступа к модели): ключ отключается надолго,
+# запрос повторяется на другом
+KEY_ERRORS = (
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+)
+
+class LLMPoolExhausted(Exception):
+    pass
+
+# Один ключ (или OpenAI-совместимый endpoint) со своими лимитами
+class ProviderKey:
+    def __init__(self, name: str, api_key: str, base_url: str = DEFAULT_BASE_URL,
+                 model: str = DEFAULT_MODEL, max_concurrency: int = 4,
+                 tokens_per_minute: int = 0, timeout: float = 120):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.timeout = timeout
+
+        self.active = 0
+        self.reserved_tokens = 0
+        self.usage = deque()
+        self.cooldown_until = 0.0
+        self.disabled_until = 0.0
+        self.rate_limit_streak = 0
+        self.last_acquired = 0.0
+
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.tokens = 0
+
+        self._client = None
+
+    @property
+    def client(self) -> OpenAI:
+        # Повторы делает пул (на другом ключе), а не клиент
+        if self._client is None:
+            self._client = OpenAI(
+                base_url=self.base_url,
+                api_key=self.api_key,
+                max_retries=0,
+                timeout=self.timeout,
+            )
+        return self._client
+
+    def tokens_used(self, now: float) -> int:
+        while self.usage and now - self.usage[0][0] > USAGE_WINDOW:
+            self.usage.popleft()
+        return sum(tokens for _, tokens in self.usage) + self.reserved_tokens
+
+    # Загрузка ключа: наибольшая из долей по параллельности и по токенам
+    def load(self, now: float) -> float:
+        load = self.active / self.max_concurrency
+        if self.tokens_per_minute:
+            load = max(load, self.tokens_used(now) / self.tokens_per_minute)
+        return load
+
+    # Момент, с которого ключ снова можно использовать
+    def available_at(self) -> float:
+        return max(self.cooldown_until, self.disabled_until)
+
+    def can_accept(self, now: float, estimate: int) -> bool:
+        if now < self.available_at() or self.active >= self.max_concurrency:
+            return False
+        if self.tokens_per_minute and self.tokens_used(now) + estimate > self.tokens_per_minute:
+            # Запрос больше всего бюджета пропускаем, когда ключ свободен, иначе он не пройдет никогда
+            return self.active == 0 and not self.usage and estimate > self.tokens_per_minute
+        return True
+
+    def snapshot(self, now: float) -> dict:
+        tokens = self.tokens_used(now)
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "concurrency_utilization": round(self.active / self.max_concurrency, 2),
+            "tokens_last_minute": tokens,
+            "tokens_per_minute": self.tokens_per_minute,
+            "tokens_utilization": round(tokens / self.tokens_per_minute, 2) if self.tokens_per_minute else None,
+            "cooldown_seconds": round(max(0.0, self.cooldown_until - now), 1),
+            "disabled": now < self.disabled_until,
+            "disabled_seconds": round(max(0.0, self.disabled_until - now), 1),
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "tokens_total": self.tokens,
+        }
+
+# Пул ключей: выбор наименее загруженного, пауза после 429 и переключение на другой ключ
+class LLMPool:
+    def __init__(self, keys: list, acquire_timeout: float = 60, cooldown: float = 30,
+                 max_cooldown: float = 300, disable_period: float = 3600):
+        self.keys = keys
+        self.acquire_timeout = acquire_timeout
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.disable_period = disable_period
+        self._condition = threading.Condition()
+
+    # Сколько запросов пул выдерживает одновременно
+    @property
+    def capacity(self) -> int:
+        return sum(key.max_concurrency for key in self.keys)
+
+    # Настройка из LLM_PROVIDERS (JSON-список) или из NOVITA_API_KEY (можно несколько через запятую)
+    @classmethod
+    def from_env(cls):
+        max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+        tokens_per_minute = int(os.getenv("LLM_TOKENS_PER_MINUTE", 0))
+
+        keys = []
+        providers = os.getenv("LLM_PROVIDERS")
+        if providers:
+            for index, provider in enumerate(json.loads(providers)):
+                keys.append(ProviderKey(
+                    name=provider.get("name", f"provider-{index + 1}"),
+                    api_key=provider["api_key"],
+                    base_url=provider.get("base_url", DEFAULT_BASE_URL),
+                    model=provider.get("model", DEFAULT_MODEL),
+                    max_concurrency=provider.get("max_concurrency", max_concurrency),
+                    tokens_per_minute=provider.get("tokens_per_minute", tokens_per_minute),
+                    timeout=provider.get("timeout", 120),
+                ))
+        else:
+            api_keys = [key.strip() for key in os.getenv("NOVITA_API_KEY", "").split(",") if key.strip()]
+            for index, api_key in enumerate(api_keys):
+                keys.append(ProviderKey(
+                    name=f"novita-{index + 1}",
+                    api_key=api_key,
+                    max_concurrency=max_concurrency,
+                    tokens_per_minute=tokens_per_minute,
+                ))
+
+        return cls(
+            keys,
+            acquire_timeout=float(os.getenv("LLM_ACQUIRE_TIMEOUT", 60)),
+            cooldown=float(os.getenv("LLM_COOLDOWN", 30)),
+            disable_period=float(os.getenv("LLM_DISABLE_PERIOD", 3600)),
+        )
+
+    def acquire(self, estimate: int) -> ProviderKey:
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                candidates = [key for key in self.keys if key.can_accept(now, estimate)]
+                if candidates:
+                    # При равной загрузке - ключ, который дольше не использовался,
+                    # чтобы и последовательные запросы расходились по ключам
+                    key = min(candidates, key=lambda candidate: (candidate.load(now), candidate.last_acquired))
+                    key.last_acquired = now
+                    key.active += 1
+                    key.reserved_tokens += estimate
+                    return key
+
+                if now >= deadline:
+                    raise LLMPoolExhausted("All LLM keys are busy or rate-limited")
+                # Не ждем впустую, если ни один ключ не освободится до истечения ожидания
+                if all(key.available_at() >= deadline for key in self.keys):
+                    raise LLMPoolExhausted("All LLM keys are paused or disabled")
+
+                # Ждем освобождения ключа или окончания паузы
+                wake_up = min(
+                    [key.available_at() for key in self.keys if key.available_at() > now] + [deadline]
+                )
+                self._condition.wait(min(wake_up - now, 1.0))
+
+    def release(self, key: ProviderKey, estimate: int, tokens: int = 0, rate_limited: bool = False,
+                failed: bool = False, disabled: bool = False, retry_after: float = None):
+        with self._condition:
+            now = time.monotonic()
+            key.active -= 1
+            key.reserved_tokens -= estimate
+            key.requests += 1
+
+            if tokens:
+                key.usage.append((now, tokens))
+                key.tokens += tokens
+
+            if rate_limited:
+                key.rate_limited += 1
+                key.rate_limit_streak += 1
+                pause = retry_after or min(self.cooldown * 2 ** (key.rate_limit_streak - 1), self.max_cooldown)
+                key.cooldown_until = now + pause
+                logger.warning(f"LLM key {key.name} rate-limited, pause {pause:.0f} s")
+            elif disabled:
+                key.failures += 1
+                key.disabled_until = now + self.disable_period
+                logger.error(f"LLM key {key.name} disabled for {self.disable_period:.0f} s")
+            elif failed:
+                key.failures += 1
+                key.cooldown_until = now + min(self.cooldown, 5)
+            else:
+                key.rate_limit_streak = 0
+
+            self._condition.notify_all()
+
+    # Запрос с переключением между ключами при 429, сетевых ошибках и ошибках ключа:
+    # ключ с ошибкой уходит на паузу, поэтому повтор достается другому.
+    # Ошибки самого запроса (400 и т.п.) ключ не наказывают и сразу пробрасываются.
+    def complete(self, messages: list, max_tokens: int, **params) -> str:
+        if not self.keys:
+            raise LLMPoolExhausted("No LLM keys configured")
+
+        estimate = sum(len(message["content"]) for message in messages) // 3 + max_tokens
+        last_error = None
+
+        for _ in range(len(self.keys) + 1):
+            with span("llm.acquire"):
+                key = self.acquire(estimate)
+
+            try:
+                with span("llm"):
+                    response = key.client.chat.completions.create(
+                        model=key.model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        **params
+                    )
+            except openai.RateLimitError as e:
+                self.release(key, estimate, rate_limited=True, retry_after=parse_retry_after(e))
+                last_error = e
+                continue
+            except RETRYABLE_ERRORS as e:
+                self.release(key, estimate, failed=True)
+                logger.warning(f"LLM key {key.name} failed: {e}")
+                last_error = e
+                continue
+            except KEY_ERRORS as e:
+                self.release(key, estimate, disabled=True)
+                logger.error(f"LLM key {key.name} rejected: {e}")
+                last_error = e
+                continue
+            except Exception:
+                self.release(key, estimate)
+                raise
+
+            usage = getattr(response, "usage", None)
+            self.release(key, estimate, tokens=usage.total_tokens if usage else estimate)
+            return response.choices[0].message.content
+
+        raise LLMPoolExhausted(f"LLM request failed on all keys: {last_error}")
+
+    def snapshot(self) -> list:
+        with self._condition:
+            now = time.monotonic()
+            return [key.snapshot(now) for key in self.keys]
+
+# Пауза из заголовка Retry-After, если провайдер его прислал
+def parse_retry_after(error) -> float:
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
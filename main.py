@@ -5,9 +5,15 @@ import threading
 import time
 import re
 import random
+import signal
+import json
+import socket
+import uuid
+import secrets
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from openai import OpenAI
 from telegram import (
     Update, 
     InlineKeyboardButton, 
@@ -22,8 +28,10 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
+from telegram.error import TelegramError
 from database import (
     add_referral,
     get_referrer_id,
@@ -31,9 +39,24 @@ from database import (
     set_bonus_count,
     get_bonus_count,
     increment_daily_counter,
+    decrement_daily_counter,
     get_daily_counter,
-    cleanup_old_counters
+    cleanup_old_counters,
+    save_conversation_contexts,
+    get_conversation_context,
+    has_conversation_context,
+    delete_conversation_context,
+    save_pending_updates,
+    pop_pending_updates,
+    set_instance_state,
+    get_polling_instances,
+    get_or_create_setting
 )
+from catchup import CatchUp
+from llm_pool import LLMPool
+from recorder import UpdateRecorder, RecordingQueue
+import tracing
+from tracing import span, traced, TracingQueue
 
 # Настройка логгирования
 logging.basicConfig(
@@ -44,9 +67,42 @@ logger = logging.getLogger(__name__)
 
 # Загрузка конфигурации
 TOKEN = os.getenv("TG_TOKEN")
-NOVITA_API_KEY = os.getenv("NOVITA_API_KEY")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "@lenaneyrobot")
 
+# Параметры плавной остановки и перезапуска. Запрос к LLM, прерванный по DRAIN_TIMEOUT,
+# продолжает выполняться в своем потоке, и процесс завершится только после него - не позже
+# таймаута клиента LLM (timeout в LLM_PROVIDERS, по умолчанию 120 с). Время на остановку
+# у оркестратора должно быть больше DRAIN_TIMEOUT плюс этот таймаут.
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 25))
+HANDOVER_TIMEOUT = float(os.getenv("HANDOVER_TIMEOUT", 45))
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 5))
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+
+# Разбор накопившихся обновлений при запуске (если DROP_PENDING_UPDATES не включен).
+# CATCHUP_MAX_QUEUE - сколько живых обновлений может ждать, прежде чем разбор приостановится
+CATCHUP_MAX_AGE = float(os.getenv("CATCHUP_MAX_AGE", 600))
+CATCHUP_RATE = float(os.getenv("CATCHUP_RATE", 0.5))
+CATCHUP_MAX_QUEUE = int(os.getenv("CATCHUP_MAX_QUEUE", 0))
+
+# Запись входящего трафика для нагрузочного тестирования (см. replay.py)
+UPDATE_RECORD_FILE = os.getenv("UPDATE_RECORD_FILE")
+UPDATE_RECORD_REDACT = os.getenv("UPDATE_RECORD_REDACT", "0") == "1"
+UPDATE_RECORD_SALT = os.getenv("UPDATE_RECORD_SALT")
+
+# Трассировка обработки сообщений (сводка: python tracing.py traces.jsonl)
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", 10))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", 10 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", 5))
+
+# Сохранение истории диалогов: по таймеру или при накоплении изменений
+CONTEXT_FLUSH_INTERVAL = float(os.getenv("CONTEXT_FLUSH_INTERVAL", 30))
+CONTEXT_FLUSH_THRESHOLD = int(os.getenv("CONTEXT_FLUSH_THRESHOLD", 50))
+
+# Идентификатор этого экземпляра бота (для передачи получения обновлений при перезапуске)
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
 # Идентификатор разработчика
 DEVELOPER_ID = 1003817394
 
@@ -56,9 +112,36 @@ UNLIMITED_CHAT_ID = -1001481824277
 # Состояния для ConversationHandler разработчика
 SELECT_USER, SELECT_ACTION, INPUT_AMOUNT = range(3)
 
+# Пул ключей LLM (LLM_PROVIDERS или NOVITA_API_KEY)
+llm_pool = LLMPool.from_env()
+
+# Сколько ответов готовить одновременно (по умолчанию - суммарная параллельность ключей)
+ANSWER_CONCURRENCY = int(os.getenv("ANSWER_CONCURRENCY", 0)) or max(llm_pool.capacity, 1)
+
 # Глобальные переменные
 user_contexts = {}
+dirty_contexts = set()
 last_cleanup_time = time.time()
+last_flush_time = time.time()
+
+# Состояние плавной остановки
+is_draining = False
+last_seen_update_id = None
+inflight_count = 0
+inflight_llm_calls = set()
+
+# Сообщения, ждущие своей очереди: update_id -> (обновление, задача обработчика)
+waiting_updates = {}
+answer_slots = None
+conversation_locks = {}
+
+# Запись обновлений (включается через UPDATE_RECORD_FILE)
+update_recorder = None
+
+# Разбор накопившихся обновлений
+catch_up = None
+catchup_task = None
+pickup_task = None
 
 # Список эмодзи для использования
 EMOJI_LIST = ["😌", "😊", "💖", "🌙", "🎭", "🤍", "💫", "🥀", "🥂", "😒"]
@@ -89,23 +172,27 @@ def check_message_limit(user_id: int) -> bool:
     global last_cleanup_time
     current_time = time.time()
     if current_time - last_cleanup_time > 1800:
-        cleanup_old_counters()
+        with span("db.cleanup"):
+            cleanup_old_counters()
         last_cleanup_time = current_time
     
     # Базовый лимит
     base_limit = 35
     
     # Бонус за рефералов
-    referral_bonus = get_referral_count(user_id) * 3
+    with span("db.referral_count"):
+        referral_bonus = get_referral_count(user_id) * 3
     
     # Постоянные бонусные сообщения
-    bonus_messages = get_bonus_count(user_id)
+    with span("db.bonus_count"):
+        bonus_messages = get_bonus_count(user_id)
     
     # Общий доступный лимит
     total_limit = base_limit + referral_bonus + bonus_messages
     
     # Получение текущего счетчика
-    current_count = get_daily_counter(user_id, today)
+    with span("db.daily_counter"):
+        current_count = get_daily_counter(user_id, today)
     
     # Проверка лимита
     if current_count >= total_limit:
@@ -166,43 +253,114 @@ def clean_response(response: str) -> str:
 # HTTP-сервер для проверки работоспособности
 class HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        self.send_response(200)
+        if self.path == "/metrics":
+            body = json.dumps(collect_metrics(), ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        
+        # Во время остановки сообщаем балансировщику, что новые запросы не принимаем
+        self.send_response(503 if is_draining else 200)
         self.send_header('Content-type', 'text/plain')
         self.end_headers()
-        self.wfile.write(b'Service is alive')
+        self.wfile.write(b'Service is draining' if is_draining else b'Service is alive')
     
     def do_HEAD(self):
-        self.send_response(200)
+        self.send_response(503 if is_draining else 200)
         self.end_headers()
 
+# Метрики для /metrics
+def collect_metrics() -> dict:
+    return {
+        "draining": is_draining,
+        "inflight": inflight_count,
+        "waiting": len(waiting_updates),
+        "answer_concurrency": ANSWER_CONCURRENCY,
+        "catchup": catch_up.stats if catch_up else None,
+        "llm_pool": llm_pool.snapshot()
+    }
+
 def run_http_server(port=8080):
     server_address = ('', port)
     httpd = HTTPServer(server_address, HealthHandler)
     logger.info(f"Starting HTTP health check server on port {port}")
     httpd.serve_forever()
 
-# Запрос к DeepSeek через Novita API
+# Получение истории диалога (после перезапуска подгружается из базы)
+def get_history(key: tuple) -> list:
+    history = user_contexts.get(key)
+    if history is None:
+        history = get_conversation_context(*key)
+        if history:
+            user_contexts[key] = history
+    return history
+
+# Сохранение измененных диалогов в базу
+def flush_conversation_state():
+    global last_flush_time
+    contexts = {key: user_contexts[key] for key in dirty_contexts if key in user_contexts}
+    save_conversation_contexts(contexts)
+    dirty_contexts.clear()
+    last_flush_time = time.time()
+
+# Учет запросов, которые нужно дождаться при остановке
+def track_request_start():
+    global inflight_count
+    inflight_count += 1
+
+def track_request_end():
+    global inflight_count
+    inflight_count -= 1
+
+# Очередь ответа: сообщения одного диалога обрабатываются по порядку,
+# а всего одновременно готовится не больше ANSWER_CONCURRENCY ответов
+@contextlib.asynccontextmanager
+async def answer_turn(key: tuple):
+    global answer_slots
+    if answer_slots is None:
+        answer_slots = asyncio.Semaphore(ANSWER_CONCURRENCY)
+    
+    lock, users = conversation_locks.get(key, (None, 0))
+    lock = lock or asyncio.Lock()
+    conversation_locks[key] = (lock, users + 1)
+    try:
+        with span("wait_turn"):
+            await lock.acquire()
+            try:
+                await answer_slots.acquire()
+            except BaseException:
+                lock.release()
+                raise
+        try:
+            yield
+        finally:
+            answer_slots.release()
+            lock.release()
+    finally:
+        lock, users = conversation_locks[key]
+        if users > 1:
+            conversation_locks[key] = (lock, users - 1)
+        else:
+            del conversation_locks[key]
+
+# Запрос к DeepSeek через пул ключей Novita / OpenAI-совместимых API
 def query_chat(messages: list) -> str:
     try:
-        client = OpenAI(
-            base_url="https://api.novita.ai/v3/openai",
-            api_key=NOVITA_API_KEY,
-        )
-        
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-r1-0528",
-            messages=messages,
+        return llm_pool.complete(
+            messages,
             temperature=0.7,
             max_tokens=600,
             stream=False,
             response_format={"type": "text"}
         )
-        return response.choices[0].message.content
     except Exception as e:
-        logger.error(f"Novita API error: {e}")
+        logger.error(f"LLM API error: {e}")
         return "Произошла ошибка при обработке запроса. Попробуйте позже."
 
 # Обработчик команды /buy
+@traced
 async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     card_number = "2200 2480 7637 0799"
@@ -221,6 +379,7 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode="HTML")
 
 # Обработчики команд
+@traced
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     
@@ -238,6 +397,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/buy - купить дополнительные запросы"
     )
 
+@traced
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("Информация", url="https://telegra.ph/O-Lene-Tihonovoj-07-11")]
@@ -250,9 +410,11 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@traced
 async def ref_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    bot_username = (await context.bot.get_me()).username
+    with span("get_me"):
+        bot_username = (await context.bot.get_me()).username
     ref_link = f"https://t.me/{bot_username}?start={user.id}"
     count = get_referral_count(user.id)
     
@@ -274,23 +436,30 @@ async def ref_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
+@traced
 async def clear_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     chat_id = update.message.chat_id
     key = (chat_id, user.id)
     
-    if key in user_contexts:
-        del user_contexts[key]
+    if get_history(key):
+        user_contexts.pop(key, None)
+        dirty_contexts.discard(key)
+        delete_conversation_context(chat_id, user.id)
         logger.info(f"Context cleared for user {user.full_name} in chat {chat_id}")
         await update.message.reply_text("История диалога очищена. Начнем заново!")
     else:
         await update.message.reply_text("У тебя еще нет истории диалога со мной!")
 
+@traced
 async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     today = datetime.utcnow().strftime("%Y-%m-%d")
     
-    has_context = any(ctx_key[1] == user.id for ctx_key in user_contexts.keys())
+    has_context = (
+        any(ctx_key[1] == user.id for ctx_key in user_contexts.keys())
+        or has_conversation_context(user.id)
+    )
     
     used_messages = get_daily_counter(user.id, today)
     
@@ -425,23 +594,12 @@ async def cancel_dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Операция отменена.")
     return ConversationHandler.END
 
-# Обработка сообщений с учетом лимитов
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.message
-    user = message.from_user
-    chat_id = message.chat_id
-    key = (chat_id, user.id)
+# Проверка, является ли сообщение адресованным боту
+def is_addressed_to_bot(message, bot_username: str) -> bool:
+    if message.chat.type == "private":
+        return True
     
-    if not message.text:
-        return
-    
-    # Улучшенная обработка групповых чатов
-    bot_username = (await context.bot.get_me()).username
-    is_private = message.chat.type == "private"
-    is_unlimited = chat_id == UNLIMITED_CHAT_ID
     bot_mention = f"@{bot_username}"
-    
-    # Проверка, является ли сообщение адресованным боту
     is_reply_to_bot = (
         message.reply_to_message and 
         message.reply_to_message.from_user.username == bot_username
@@ -453,13 +611,48 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1. Ответы на сообщения бота
     # 2. Сообщения с упоминанием бота (@username)
     # 3. Сообщения с именем бота в тексте (без @)
-    is_addressed_to_bot = is_reply_to_bot or is_mention or is_bot_name_in_text
+    return bool(is_reply_to_bot or is_mention or is_bot_name_in_text)
+
+# Обработка сообщений с учетом лимитов. Обработчик неблокирующий (block=False),
+# поэтому ответы разным пользователям готовятся параллельно
+@traced
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    user = message.from_user
+    chat_id = message.chat_id
+    key = (chat_id, user.id)
+    
+    if not message.text:
+        tracing.discard()
+        return
+    
+    # Улучшенная обработка групповых чатов
+    with span("get_me"):
+        bot_username = (await context.bot.get_me()).username
+    is_unlimited = chat_id == UNLIMITED_CHAT_ID
     
     # В групповых чатах (не приватных) игнорируем сообщения не адресованные боту
-    if not is_private and not is_addressed_to_bot:
+    if not is_addressed_to_bot(message, bot_username):
+        tracing.discard()
         return
     
+    # Пока сообщение ждет очереди, при остановке его можно передать новому экземпляру
+    waiting_updates[update.update_id] = (update, asyncio.current_task())
+    try:
+        async with answer_turn(key):
+            if waiting_updates.pop(update.update_id, None) is None:
+                return
+            await answer_if_allowed(message, context, key, is_unlimited)
+    finally:
+        waiting_updates.pop(update.update_id, None)
+
+# Проверка лимита, списание сообщения и ответ
+async def answer_if_allowed(message, context: ContextTypes.DEFAULT_TYPE, key: tuple, is_unlimited: bool):
+    user = message.from_user
+    chat_id = message.chat_id
+    
     # Проверка лимита сообщений (только для обычных чатов)
+    charged_day = None
     if not is_unlimited:
         # Проверяем лимит перед увеличением счетчика
         if not check_message_limit(user.id):
@@ -482,15 +675,29 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Увеличиваем счетчик сообщений только если лимит не превышен
-        today = datetime.utcnow().strftime("%Y-%m-%d")
-        increment_daily_counter(user.id, today)
+        charged_day = datetime.utcnow().strftime("%Y-%m-%d")
+        with span("db.increment_counter"):
+            increment_daily_counter(user.id, charged_day)
     
     logger.info(f"Обработка сообщения от {user.full_name} в чате {chat_id}: {message.text}")
     
-    await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+    track_request_start()
+    try:
+        await answer_message(message, context, key, charged_day)
+    finally:
+        track_request_end()
+
+# Генерация и отправка ответа на сообщение; charged_day - день, за который списано сообщение
+async def answer_message(message, context: ContextTypes.DEFAULT_TYPE, key: tuple, charged_day: str = None):
+    user = message.from_user
+    chat_id = message.chat_id
+    
+    with span("send_chat_action"):
+        await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
     
     try:
-        history = user_contexts.get(key, [])
+        with span("history"):
+            history = get_history(key)
         user_message_content = f"{user.full_name}: {message.text}"
         user_message = {"role": "user", "content": user_message_content}
         
@@ -498,9 +705,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         messages.extend(history)
         messages.append(user_message)
         
+        # Собственное время участка executor - ожидание свободного потока
         loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, query_chat, messages)
-        cleaned_response = clean_response(response)
+        with span("executor"):
+            llm_call = tracing.run_in_executor(loop, query_chat, messages)
+            inflight_llm_calls.add(llm_call)
+            try:
+                response = await llm_call
+            finally:
+                inflight_llm_calls.discard(llm_call)
+        
+        with span("clean_response"):
+            cleaned_response = clean_response(response)
         
         if not cleaned_response.strip():
             cleaned_response = "Я обдумываю твой вопрос... Попробуй спросить по-другому."
@@ -512,10 +728,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             history = history[-10:]
         
         user_contexts[key] = history
+        dirty_contexts.add(key)
+        # Во время остановки новый экземпляр уже может читать историю из базы
+        if is_draining or len(dirty_contexts) >= CONTEXT_FLUSH_THRESHOLD:
+            flush_conversation_state()
         
         # Отправляем ответ без форматирования Markdown
-        await message.reply_text(cleaned_response)
-            
+        with span("reply_text"):
+            await message.reply_text(cleaned_response)
+    
+    except asyncio.CancelledError:
+        # Запрос не успел завершиться за время остановки бота
+        logger.warning(f"Запрос от {user.full_name} в чате {chat_id} прерван при остановке бота")
+        # Пользователя просим повторить сообщение, поэтому списанное возвращаем
+        if charged_day:
+            decrement_daily_counter(user.id, charged_day)
+        await message.reply_text("Меня перезапускают... Повтори, пожалуйста, сообщение через минутку.")
     except Exception as e:
         logger.error(f"Ошибка обработки сообщения: {e}")
         await message.reply_text("Что-то пошло не так. Попробуйте еще раз.")
@@ -531,24 +759,222 @@ async def post_init(application: Application) -> None:
     ]
     await application.bot.set_my_commands(commands)
     logger.info("Меню команд бота установлено")
+    
+    if update_recorder:
+        update_recorder.bot_username = application.bot.username
 
-def main():
-    if not TOKEN:
-        logger.error("TG_TOKEN environment variable is missing!")
+# Запоминаем последнее обновление, взятое в обработку
+async def track_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global last_seen_update_id
+    last_seen_update_id = update.update_id
+
+# Ожидание, пока предыдущий экземпляр бота отпустит получение обновлений.
+# Экземпляр, получающий обновления, отмечается в bot_instances каждые HEARTBEAT_INTERVAL
+# секунд и при остановке переходит в 'released' после сохранения очереди;
+# упавший экземпляр перестает отмечаться и через три интервала не учитывается.
+async def wait_for_polling_handover(timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    
+    while get_polling_instances(INSTANCE_ID, HEARTBEAT_INTERVAL * 3):
+        if time.monotonic() >= deadline:
+            logger.warning("Предыдущий экземпляр бота все еще получает обновления, запускаемся без ожидания")
+            return False
+        await asyncio.sleep(0.5)
+    
+    logger.info("Получение обновлений свободно, запускаем бота")
+    return True
+
+# Периодические задачи: отметка экземпляра и сохранение истории диалогов
+async def maintenance_loop():
+    while True:
+        set_instance_state(INSTANCE_ID, "polling")
+        if dirty_contexts and time.time() - last_flush_time >= CONTEXT_FLUSH_INTERVAL:
+            flush_conversation_state()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+# Извлечение еще не обработанных обновлений: ждущих своей очереди в обработчике
+# (их задачи отменяются) и еще не взятых из очереди приложения
+def release_queued_updates(application: Application) -> list:
+    released = []
+    for update_id in sorted(waiting_updates):
+        update, task = waiting_updates.pop(update_id)
+        task.cancel()
+        released.append(update)
+    
+    while True:
+        try:
+            item = application.update_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        application.update_queue.task_done()
+        if isinstance(item, Update):
+            released.append(item)
+    return released
+
+# Живой трафик ждет ответа: накопившиеся обновления пока не передаем в обработку
+def has_live_backlog(application: Application) -> bool:
+    waiting = application.update_queue.qsize() + len(waiting_updates)
+    return waiting > CATCHUP_MAX_QUEUE or inflight_count >= ANSWER_CONCURRENCY
+
+def start_catchup_feed(application: Application):
+    global catchup_task
+    catchup_task = asyncio.create_task(catch_up.feed(application, lambda: has_live_backlog(application)))
+
+# Пул потоков для запросов к LLM: по потоку на каждый одновременный ответ
+def make_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=ANSWER_CONCURRENCY + 4)
+
+# Подтверждение всех полученных обновлений. Updater подтверждает пачку уже при
+# следующем запросе, поэтому Telegram не вернет обновления, ждущие в очереди
+# приложения, - они передаются новому экземпляру через базу (hand_off_updates)
+async def acknowledge_updates(bot, released: list):
+    update_ids = [update.update_id for update in released]
+    if last_seen_update_id is not None:
+        update_ids.append(last_seen_update_id)
+    if not update_ids:
         return
-    if not NOVITA_API_KEY:
-        logger.error("NOVITA_API_KEY environment variable is missing!")
+    
+    offset = max(update_ids) + 1
+    try:
+        await bot.get_updates(offset=offset, timeout=0, limit=1)
+        logger.info(f"Обновления подтверждены до {offset}")
+    except TelegramError as e:
+        logger.warning(f"Не удалось подтвердить обновления: {e}")
+
+# Ожидание, пока не останется запросов в обработке и в очереди ответа
+async def wait_until_idle(timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while inflight_count > 0 or waiting_updates:
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True
+
+# Ожидание завершения запросов, принятых до остановки
+async def drain_in_flight(timeout: float):
+    if await wait_until_idle(timeout):
         return
+    
+    logger.warning(
+        f"Не все запросы завершились за {timeout} с, прерываем: {inflight_count}. "
+        f"Процесс завершится после их потоков (до {max((key.timeout for key in llm_pool.keys), default=0):.0f} с)"
+    )
+    for llm_call in list(inflight_llm_calls):
+        llm_call.cancel()
+    
+    if not await wait_until_idle(5):
+        logger.error(f"Запросы не завершились после прерывания: {inflight_count}")
 
-    # Запуск HTTP-сервера
-    port = int(os.getenv('PORT', 8080))
-    http_thread = threading.Thread(target=run_http_server, args=(port,), daemon=True)
-    http_thread.start()
+# Передача необработанных обновлений новому экземпляру: сохраняем их в базе
+# и только после этого отпускаем получение обновлений
+def hand_off_updates(updates: list):
+    save_pending_updates([update.to_dict() for update in updates])
+    set_instance_state(INSTANCE_ID, "released")
+    logger.info(f"Получение обновлений передано, необработанных: {len(updates)}")
 
-    logger.info("Ожидание 45 секунд перед запуском бота...")
-    time.sleep(45)
+# Разбор обновлений, сохраненных предыдущим экземпляром. Берем их только после того,
+# как он отпустил получение обновлений, иначе сохранение еще не закончено.
+def pick_up_saved_updates(application: Application):
+    saved_updates = pop_pending_updates()
+    if DROP_PENDING_UPDATES:
+        if saved_updates:
+            logger.info(f"Пропущено обновлений, сохраненных предыдущим экземпляром: {len(saved_updates)}")
+        return []
+    
+    bot = application.bot
+    return [Update.de_json(data, bot) for data in saved_updates]
 
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+# Если предыдущий экземпляр не отпустил получение обновлений за HANDOVER_TIMEOUT,
+# дожидаемся его остановки в фоне и добавляем сохраненные им обновления в разбор
+async def pick_up_late_handover(application: Application):
+    while get_polling_instances(INSTANCE_ID, HEARTBEAT_INTERVAL * 3):
+        await asyncio.sleep(1)
+    
+    restored = pick_up_saved_updates(application)
+    if not restored or not catch_up:
+        return
+    
+    bot = application.bot
+    catch_up.add(restored, bot, lambda message: is_addressed_to_bot(message, bot.username))
+    catch_up.stats["restored"] += len(restored)
+    logger.info(f"Предыдущий экземпляр остановился, передано обновлений: {len(restored)}")
+    
+    if catchup_task is None or catchup_task.done():
+        start_catchup_feed(application)
+
+# Плавная остановка: прекращаем прием, дожидаемся ответов, сохраняем состояние
+async def shutdown_gracefully(application: Application, maintenance_task: asyncio.Task):
+    global is_draining
+    is_draining = True
+    logger.info("Получен сигнал остановки, прекращаем прием обновлений...")
+    
+    await application.updater.stop()
+    # Файл записи закрываем до передачи получения обновлений: новый экземпляр
+    # продолжит его, а не сочтет оборванным
+    if update_recorder:
+        update_recorder.close()
+    maintenance_task.cancel()
+    if pickup_task:
+        pickup_task.cancel()
+    if catchup_task:
+        catchup_task.cancel()
+    
+    released = release_queued_updates(application)
+    if catch_up:
+        released += catch_up.remaining()
+    await acknowledge_updates(application.bot, released)
+    # История должна попасть в базу до того, как новый экземпляр начнет ее читать
+    flush_conversation_state()
+    hand_off_updates(released)
+    
+    await drain_in_flight(DRAIN_TIMEOUT)
+    await application.stop()
+    
+    flush_conversation_state()
+    logger.info("Бот остановлен")
+
+async def run_bot(application: Application, poll_params: dict):
+    global catch_up, pickup_task
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(make_executor())
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    async with application:
+        await post_init(application)
+        handed_over = await wait_for_polling_handover(HANDOVER_TIMEOUT)
+        
+        # Обновления, сохраненные предыдущим экземпляром при остановке
+        restored = pick_up_saved_updates(application) if handed_over else []
+        
+        if not DROP_PENDING_UPDATES:
+            bot = application.bot
+            catch_up = CatchUp(CATCHUP_MAX_AGE, CATCHUP_RATE)
+            await catch_up.load(bot, restored, lambda message: is_addressed_to_bot(message, bot.username))
+        
+        if update_recorder:
+            update_recorder.open()
+        
+        await application.updater.start_polling(**poll_params)
+        await application.start()
+        maintenance_task = asyncio.create_task(maintenance_loop())
+        
+        if catch_up:
+            start_catchup_feed(application)
+        if not handed_over:
+            pickup_task = asyncio.create_task(pick_up_late_handover(application))
+        
+        await stop_event.wait()
+        await shutdown_gracefully(application, maintenance_task)
+
+# Регистрация обработчиков (используется также в replay.py)
+def register_handlers(application: Application):
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
     
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("start", start))
@@ -573,21 +999,60 @@ def main():
     
     # Основной обработчик сообщений
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False)
     )
+
+def main():
+    global update_recorder
+    
+    if not TOKEN:
+        logger.error("TG_TOKEN environment variable is missing!")
+        return
+    if not llm_pool.keys:
+        logger.error("NOVITA_API_KEY or LLM_PROVIDERS environment variable is missing!")
+        return
+
+    # Запуск HTTP-сервера
+    port = int(os.getenv('PORT', 8080))
+    http_thread = threading.Thread(target=run_http_server, args=(port,), daemon=True)
+    http_thread.start()
+
+    builder = Application.builder().token(TOKEN)
+    
+    if TRACE_FILE:
+        tracing.configure(
+            TRACE_FILE,
+            slow=TRACE_SLOW_THRESHOLD,
+            rate=TRACE_SAMPLE_RATE,
+            max_bytes=TRACE_MAX_BYTES,
+            backup_count=TRACE_BACKUP_COUNT
+        )
+        builder = builder.update_queue(TracingQueue())
+    
+    if UPDATE_RECORD_FILE:
+        # Соль сохраняется в базе, чтобы псевдонимы пользователей не менялись между запусками
+        salt = UPDATE_RECORD_SALT or get_or_create_setting("update_record_salt", secrets.token_hex(16))
+        update_recorder = UpdateRecorder(
+            UPDATE_RECORD_FILE,
+            salt=salt,
+            redact_text=UPDATE_RECORD_REDACT,
+            preserved_chat_ids=[UNLIMITED_CHAT_ID]
+        )
+        builder = builder.update_queue(RecordingQueue(update_recorder))
+    
+    application = builder.build()
+    register_handlers(application)
     
     logger.info("Запуск бота в режиме polling...")
     
     poll_params = {
-        "drop_pending_updates": True,
-        "close_loop": False,
-        "stop_signals": [],
+        "drop_pending_updates": DROP_PENDING_UPDATES,
         "connect_timeout": 60,
         "read_timeout": 60,
         "pool_timeout": 60
     }
     
-    application.run_polling(**poll_params)
+    asyncio.run(run_bot(application, poll_params))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,250 @@
+import json
+import time
+import random
+import socket
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_pool import LLMPool, ProviderKey
+
+# Локальные OpenAI-совместимые endpoint'ы с разными лимитами для проверки пула ключей.
+# Пример: python mock_llm.py 9001:2:20000 9002:4:60000 --latency 3
+# и LLM_PROVIDERS='[{"name": "a", "api_key": "x", "base_url": "http://127.0.0.1:9001/v1", "max_concurrency": 2, "tokens_per_minute": 20000}, ...]'
+# Самопроверка пула ключей на двух заглушках: python mock_llm.py --check
+
+logger = logging.getLogger(__name__)
+
+# Ключ, который заглушка отклоняет с 401
+REVOKED_KEY = "revoked"
+
+# Один endpoint: ограничение параллельных запросов и токенов в минуту, сверх них - 429
+class MockEndpoint:
+    def __init__(self, port: int, max_concurrency: int, tokens_per_minute: int,
+                 latency: float, completion_tokens: int, retry_after: float = 5):
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.retry_after = retry_after
+        self.active = 0
+        self.usage = deque()
+        self.served = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def admit(self, tokens: int) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            while self.usage and now - self.usage[0][0] > 60:
+                self.usage.popleft()
+            used = sum(count for _, count in self.usage)
+            if self.active >= self.max_concurrency or (self.tokens_per_minute and used + tokens > self.tokens_per_minute):
+                self.rejected += 1
+                return False
+            self.active += 1
+            self.usage.append((now, tokens))
+            return True
+
+    def done(self):
+        with self.lock:
+            self.active -= 1
+            self.served += 1
+
+def make_handler(endpoint: MockEndpoint):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, payload: dict, headers: dict = None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if not self.path.endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "not found"}})
+                return
+
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.headers.get("Authorization") == f"Bearer {REVOKED_KEY}":
+                self.send_json(401, {"error": {"message": "Invalid API key", "type": "invalid_request_error"}})
+                return
+
+            prompt_tokens = sum(len(message.get("content", "")) for message in request.get("messages", [])) // 3
+            completion_tokens = min(request.get("max_tokens") or endpoint.completion_tokens, endpoint.completion_tokens)
+            total_tokens = prompt_tokens + completion_tokens
+
+            if not endpoint.admit(total_tokens):
+                self.send_json(
+                    429,
+                    {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                    {"Retry-After": f"{endpoint.retry_after:g}"}
+                )
+                return
+
+            try:
+                time.sleep(random.lognormvariate(0, 0.4) * endpoint.latency)
+                self.send_json(200, {
+                    "id": f"mock-{endpoint.port}-{time.time_ns()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": f"*смотрит в окно* Ответ с порта {endpoint.port}."},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": total_tokens,
+                    },
+                })
+            finally:
+                endpoint.done()
+
+    return Handler
+
+# Запуск endpoint'а в фоновом потоке; порт 0 - любой свободный
+def start_endpoint(port: int, max_concurrency: int, tokens_per_minute: int, latency: float,
+                   completion_tokens: int = 300, retry_after: float = 5):
+    endpoint = MockEndpoint(port, max_concurrency, tokens_per_minute, latency, completion_tokens, retry_after)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(endpoint))
+    endpoint.port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return endpoint, server
+
+def make_key(name: str, port: int, max_concurrency: int, api_key: str = "mock") -> ProviderKey:
+    return ProviderKey(
+        name=name,
+        api_key=api_key,
+        base_url=f"http://127.0.0.1:{port}/v1",
+        model="mock",
+        max_concurrency=max_concurrency,
+        timeout=10,
+    )
+
+def run_requests(pool: LLMPool, count: int, workers: int) -> list:
+    messages = [{"role": "user", "content": "Привет!"}]
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(pool.complete, messages, max_tokens=50) for _ in range(count)]
+        return [future.result() for future in futures]
+
+def key_stats(pool: LLMPool) -> dict:
+    return {key["name"]: key for key in pool.snapshot()}
+
+# Проверка пула ключей: распределение по лимитам, переключение при 429, сетевой
+# ошибке и отозванном ключе, возврат ключа после паузы
+def run_check():
+    # Лимиты ключей совпадают с лимитами endpoint'ов: нагрузка делится без 429
+    a, server_a = start_endpoint(0, max_concurrency=1, tokens_per_minute=0, latency=0.3)
+    b, server_b = start_endpoint(0, max_concurrency=3, tokens_per_minute=0, latency=0.3)
+    pool = LLMPool([make_key("a", a.port, 1), make_key("b", b.port, 3)], acquire_timeout=10)
+    run_requests(pool, 12, workers=4)
+    assert a.rejected == 0 and b.rejected == 0, f"unexpected 429: a={a.rejected}, b={b.rejected}"
+    assert a.served > 0 and b.served > a.served, f"split does not follow limits: a={a.served}, b={b.served}"
+    print(f"OK: распределение по лимитам a={a.served}, b={b.served}, без 429")
+
+    # Последовательные запросы при равной загрузке ключей расходятся по очереди
+    served = (a.served, b.served)
+    run_requests(pool, 6, workers=1)
+    split = (a.served - served[0], b.served - served[1])
+    assert split == (3, 3), f"sequential requests not spread: a={split[0]}, b={split[1]}"
+    print("OK: последовательные запросы чередуются между ключами")
+    server_a.shutdown()
+    server_b.shutdown()
+
+    # Ключ обещает больше, чем выдерживает endpoint: лишние запросы получают 429 и уходят на другой ключ
+    a, server_a = start_endpoint(0, max_concurrency=1, tokens_per_minute=0, latency=0.3, retry_after=0.5)
+    b, server_b = start_endpoint(0, max_concurrency=3, tokens_per_minute=0, latency=0.3)
+    pool = LLMPool([make_key("a", a.port, 3), make_key("b", b.port, 3)], acquire_timeout=10)
+    replies = run_requests(pool, 4, workers=4)
+    stats = key_stats(pool)
+    assert len(replies) == 4, "not all requests completed"
+    assert a.rejected > 0 and stats["a"]["rate_limited"] == a.rejected, f"no 429 failover: {stats['a']}"
+    print(f"OK: переключение при 429 (отклонено a: {a.rejected}, обслужено b: {b.served})")
+
+    # Сетевая ошибка: ключ на закрытом порту уходит на паузу, запрос выполняется на другом
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        closed_port = probe.getsockname()[1]
+    pool = LLMPool([make_key("dead", closed_port, 2), make_key("b", b.port, 3)], acquire_timeout=10, cooldown=1)
+    reply = pool.complete([{"role": "user", "content": "Привет!"}], max_tokens=50)
+    stats = key_stats(pool)
+    assert str(b.port) in reply, f"reply not from b: {reply}"
+    assert stats["dead"]["failures"] == 1 and stats["dead"]["cooldown_seconds"] > 0, f"dead key not paused: {stats['dead']}"
+    print("OK: переключение при сетевой ошибке")
+
+    # Пока ключ на паузе, выдается другой; после паузы он снова доступен
+    key = pool.acquire(1)
+    pool.release(key, 1)
+    assert key.name == "b", f"paused key was acquired: {key.name}"
+    time.sleep(stats["dead"]["cooldown_seconds"] + 0.1)
+    key = pool.acquire(1)
+    pool.release(key, 1)
+    assert key.name == "dead", f"key not back after cooldown: {key.name}"
+    print("OK: ключ возвращается после паузы")
+
+    # Отозванный ключ (401) отключается надолго, запрос выполняется на другом
+    pool = LLMPool([make_key("revoked", a.port, 3, api_key=REVOKED_KEY), make_key("b", b.port, 3)], acquire_timeout=10)
+    reply = pool.complete([{"role": "user", "content": "Привет!"}], max_tokens=50)
+    stats = key_stats(pool)
+    assert str(b.port) in reply and stats["revoked"]["disabled"], f"revoked key not disabled: {stats['revoked']}"
+    print("OK: отозванный ключ отключен")
+
+    server_a.shutdown()
+    server_b.shutdown()
+    print("Проверка пула ключей пройдена")
+
+def parse_endpoint(spec: str):
+    parts = [int(part) for part in spec.split(":")]
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError("expected PORT:CONCURRENCY:TOKENS_PER_MINUTE")
+    return parts
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушки OpenAI-совместимого API с лимитами")
+    parser.add_argument("endpoints", nargs="*", type=parse_endpoint, help="PORT:CONCURRENCY:TOKENS_PER_MINUTE")
+    parser.add_argument("--latency", type=float, default=3.0, help="средняя задержка ответа, секунды")
+    parser.add_argument("--completion-tokens", type=int, default=300)
+    parser.add_argument("--retry-after", type=float, default=5, help="Retry-After в ответах 429, секунды")
+    parser.add_argument("--check", action="store_true", help="проверить пул ключей на двух заглушках и выйти")
+    args = parser.parse_args()
+
+    if args.check:
+        logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.ERROR)
+        run_check()
+        return
+    if not args.endpoints:
+        parser.error("at least one endpoint is required")
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    endpoints = []
+    for port, max_concurrency, tokens_per_minute in args.endpoints:
+        endpoint, _ = start_endpoint(
+            port, max_concurrency, tokens_per_minute, args.latency, args.completion_tokens, args.retry_after
+        )
+        endpoints.append(endpoint)
+        logger.info(f"Mock LLM on port {port}: concurrency {max_concurrency}, {tokens_per_minute} tokens/min")
+
+    try:
+        while True:
+            time.sleep(10)
+            for endpoint in endpoints:
+                logger.info(f"port {endpoint.port}: active {endpoint.active}, served {endpoint.served}, rejected {endpoint.rejected}")
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import os
+import gzip
+import zlib
+import json
+import hashlib
+import logging
+import secrets
+import time
+from datetime import datetime
+
+from telegram import Update
+
+from tracing import TracingQueue
+
+logger = logging.getLogger(__name__)
+
+RECORD_FORMAT = "leno-updates"
+RECORD_VERSION = 1
+
+# Как часто сбрасывать сжатый буфер на диск (секунды)
+FLUSH_INTERVAL = 5
+
+# Как часто закрывать gzip-блок и начинать новый (секунды): после падения бота
+# теряется только незакрытый хвост
+REOPEN_INTERVAL = 60
+
+# Ошибки чтения файла, оборванного без завершения gzip-потока
+TRUNCATION_ERRORS = (EOFError, zlib.error, gzip.BadGzipFile)
+
+# Поля с персональными данными, которые удаляются из записи целиком
+DROPPED_FIELDS = {"last_name", "phone_number", "contact", "location", "venue", "bio"}
+
+# Анонимизирующая запись входящих обновлений для последующего воспроизведения
+class UpdateRecorder:
+    def __init__(self, path: str, salt: str = None, redact_text: bool = False,
+                 preserved_chat_ids=(), bot_username: str = None):
+        self.path = path
+        self.salt = salt or secrets.token_hex(16)
+        self.redact_text = redact_text
+        self.preserved_chat_ids = set(preserved_chat_ids)
+        self.bot_username = bot_username
+        self.started_at = None
+        self.records = 0
+        self._file = None
+        self._closed = False
+        self._last_flush = 0.0
+        self._opened_at = 0.0
+
+    # Стабильный псевдоним для ID пользователя или чата
+    def hash_id(self, value: int) -> int:
+        digest = hashlib.blake2b(f"{self.salt}:{abs(value)}".encode(), digest_size=6).digest()
+        hashed = int.from_bytes(digest, "big") or 1
+        return -hashed if value < 0 else hashed
+
+    # Замена текста с сохранением длины, команд и обращений к боту
+    def anonymize_text(self, text: str) -> str:
+        bot_name = (self.bot_username or "").lower()
+        words = text.split(" ")
+        result = []
+
+        for index, word in enumerate(words):
+            if index == 1 and words[0].startswith("/start") and word.isdigit():
+                # Реферальная ссылка: ID пригласившего хэшируется так же, как ID пользователей
+                result.append(str(self.hash_id(int(word))))
+            elif not self.redact_text:
+                result.append(word)
+            elif (index == 0 and word.startswith("/")) or (bot_name and bot_name in word.lower()):
+                result.append(word)
+            else:
+                # Сохраняем длину в UTF-16, чтобы смещения entities оставались верными
+                result.append("".join(
+                    ch if ch.isspace() else "x" * (len(ch.encode("utf-16-le")) // 2)
+                    for ch in word
+                ))
+
+        return " ".join(result)
+
+    def anonymize(self, data):
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for field, value in data.items():
+            if field in DROPPED_FIELDS:
+                continue
+            result[field] = self.anonymize(value)
+
+        if "is_bot" in data and not data["is_bot"]:
+            # Пользователь
+            hashed = self.hash_id(data["id"])
+            result["id"] = hashed
+            result["first_name"] = f"User{hashed % 100000}"
+            if "username" in data:
+                result["username"] = f"user{hashed}"
+        elif "type" in data and "id" in data and isinstance(data["id"], int):
+            # Чат: безлимитный и другие отмеченные чаты сохраняем как есть
+            if data["id"] not in self.preserved_chat_ids:
+                hashed = self.hash_id(data["id"])
+                result["id"] = hashed
+                for field in ("title", "first_name", "username"):
+                    if field in data:
+                        result[field] = f"{field}{abs(hashed)}"
+
+        for field in ("text", "caption"):
+            if isinstance(data.get(field), str):
+                result[field] = self.anonymize_text(data[field])
+
+        return result
+
+    # Открытие файла записи. Проверка прошлой записи читает весь файл, поэтому
+    # вызывается до начала получения обновлений, а не при первом из них.
+    def open(self):
+        try:
+            self._open()
+        except Exception as e:
+            self._closed = True
+            logger.error(f"Error opening update recording, recording disabled: {e}")
+
+    def _open(self):
+        # Оборванный прошлым запуском файл не дописываем: следующие блоки было бы не прочитать
+        if os.path.exists(self.path) and not is_complete(self.path):
+            broken_path = f"{self.path}.{int(time.time())}"
+            os.rename(self.path, broken_path)
+            logger.warning(f"Запись {self.path} оборвана, сохранена как {broken_path}")
+
+        self.started_at = time.time()
+        self._file = gzip.open(self.path, "at", encoding="utf-8")
+        self._opened_at = time.monotonic()
+        header = {
+            "format": RECORD_FORMAT,
+            "version": RECORD_VERSION,
+            "started_at": datetime.utcfromtimestamp(self.started_at).isoformat(),
+            "redacted": self.redact_text,
+            "bot_username": self.bot_username,
+        }
+        self._file.write(json.dumps(header, separators=(",", ":")) + "\n")
+        logger.info(f"Запись обновлений в {self.path}")
+
+    def record(self, update: Update):
+        if self._closed:
+            return
+        try:
+            if self._file is None:
+                self._open()
+
+            entry = {
+                "t": round(time.time() - self.started_at, 3),
+                "u": self.anonymize(update.to_dict()),
+            }
+            self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.records += 1
+
+            now = time.monotonic()
+            if now - self._opened_at > REOPEN_INTERVAL:
+                self._file.close()
+                self._file = gzip.open(self.path, "at", encoding="utf-8")
+                self._opened_at = now
+                self._last_flush = now
+            elif now - self._last_flush > FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = now
+        except Exception as e:
+            logger.error(f"Error recording update: {e}")
+
+    def close(self):
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Запись обновлений завершена: {self.records}")
+
+# Очередь обновлений, которая записывает каждое обновление в момент получения
+class RecordingQueue(TracingQueue):
+    def __init__(self, recorder: UpdateRecorder):
+        super().__init__()
+        self.recorder = recorder
+
+    def put_nowait(self, item):
+        if isinstance(item, Update):
+            self.recorder.record(item)
+        super().put_nowait(item)
+
+    # Постановка в очередь без записи (накопившиеся за перезапуск обновления)
+    def put_unrecorded(self, item):
+        super().put_nowait(item)
+
+# Проверка, что gzip-поток файла завершен
+def is_complete(path: str) -> bool:
+    try:
+        with gzip.open(path, "rb") as f:
+            while f.read(1024 * 1024):
+                pass
+        return True
+    except TRUNCATION_ERRORS:
+        return False
+
+# Чтение записи: возвращает заголовок и список (время, данные обновления).
+# Если бот упал, не закрыв файл, читается все, что успело попасть на диск.
+def load_recording(path: str):
+    header = None
+    base = 0.0
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка
+                    continue
+                if "format" in data:
+                    # Файл мог дописываться несколькими запусками: время считаем от первого
+                    if header is None:
+                        header = data
+                    else:
+                        first = datetime.fromisoformat(header["started_at"])
+                        base = (datetime.fromisoformat(data["started_at"]) - first).total_seconds()
+                    continue
+                entries.append((base + data["t"], data["u"]))
+        except TRUNCATION_ERRORS as e:
+            logger.warning(f"Запись {path} оборвана, прочитано обновлений: {len(entries)} ({e})")
+
+    if header is None or header.get("format") != RECORD_FORMAT:
+        raise ValueError(f"{path} is not an update recording")
+
+    entries.sort(key=lambda entry: entry[0])
+    return header, entries
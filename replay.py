@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextvars
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+import database
+import main as bot_main
+from recorder import load_recording
+import tracing
+from tracing import percentile, TracingQueue
+
+# Воспроизведение записанного трафика (UPDATE_RECORD_FILE) против заглушки Telegram и LLM.
+# Пример: python replay.py updates.jsonl.gz --speed 10 --llm-latency 6
+# С --real-llm запросы идут через пул ключей (LLM_PROVIDERS), например на заглушки из mock_llm.py
+
+logger = logging.getLogger(__name__)
+
+# Обновление, которое обрабатывается в текущей задаче
+current_update_id = contextvars.ContextVar("current_update_id", default=None)
+
+# Статистика воспроизведения
+class ReplayStats:
+    def __init__(self):
+        self.arrivals = {}
+        self.started = {}
+        self.replied = {}
+        self.api_calls = {}
+        self.llm_calls = 0
+        self.max_queue_size = 0
+
+    def api_call(self, endpoint: str):
+        self.api_calls[endpoint] = self.api_calls.get(endpoint, 0) + 1
+        if endpoint == "sendMessage":
+            update_id = current_update_id.get()
+            if update_id is not None and update_id not in self.replied:
+                self.replied[update_id] = time.monotonic()
+
+# Заглушка Bot API: отвечает успехом без обращения к сети
+class StubRequest(BaseRequest):
+    def __init__(self, stats: ReplayStats, bot_username: str):
+        self.stats = stats
+        self.bot_user = {"id": 1, "is_bot": True, "first_name": "Лена", "username": bot_username}
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.stats.api_call(endpoint)
+
+        if endpoint == "getMe":
+            result = self.bot_user
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self.message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": self.bot_user,
+                "text": params.get("text", ""),
+            }
+        elif endpoint == "getUpdates":
+            result = []
+        else:
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# Заглушка LLM с логнормальной задержкой
+def make_mock_query_chat(stats: ReplayStats, mean_latency: float, sigma: float):
+    def mock_query_chat(messages: list) -> str:
+        stats.llm_calls += 1
+        if mean_latency > 0:
+            time.sleep(random.lognormvariate(0, sigma) * mean_latency)
+        return "Я немного подумала... *смотрит в книгу* Давай поговорим об этом позже."
+    return mock_query_chat
+
+def format_distribution(values: list) -> str:
+    if not values:
+        return "нет данных"
+    return (
+        f"p50={percentile(values, 50):.2f}s p90={percentile(values, 90):.2f}s "
+        f"p99={percentile(values, 99):.2f}s max={max(values):.2f}s"
+    )
+
+async def replay(entries: list, bot_username: str, speed: float, stats: ReplayStats,
+                 drain_timeout: float) -> float:
+    application = (
+        Application.builder()
+        .token("1:REPLAY")
+        .request(StubRequest(stats, bot_username))
+        .get_updates_request(StubRequest(stats, bot_username))
+        .update_queue(TracingQueue())
+        .build()
+    )
+
+    async def mark_started(update: Update, context):
+        current_update_id.set(update.update_id)
+        stats.started[update.update_id] = time.monotonic()
+
+    application.add_handler(TypeHandler(Update, mark_started), group=-100)
+    bot_main.register_handlers(application)
+
+    # Сообщения для LLM ждут очереди ответа уже в обработчике: началом обработки
+    # считаем момент, когда очередь подошла
+    answer_if_allowed = bot_main.answer_if_allowed
+
+    async def mark_answer_started(message, *args):
+        stats.started[current_update_id.get()] = time.monotonic()
+        return await answer_if_allowed(message, *args)
+
+    bot_main.answer_if_allowed = mark_answer_started
+
+    asyncio.get_running_loop().set_default_executor(bot_main.make_executor())
+    
+    async with application:
+        await application.start()
+
+        begin = time.monotonic()
+        for offset, data in entries:
+            delay = offset / speed - (time.monotonic() - begin)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            update = Update.de_json(data, application.bot)
+            stats.arrivals[update.update_id] = time.monotonic()
+            await application.update_queue.put(update)
+            stats.max_queue_size = max(stats.max_queue_size, application.update_queue.qsize())
+
+        drain_started = time.monotonic()
+        try:
+            await asyncio.wait_for(application.update_queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь не разобрана за {drain_timeout} с")
+        # Ответы готовятся в неблокирующем обработчике уже после выхода из очереди
+        if not await bot_main.wait_until_idle(max(0.0, drain_timeout - (time.monotonic() - drain_started))):
+            logger.warning(f"Ответы не готовы за {drain_timeout} с")
+        elapsed = time.monotonic() - begin
+
+        await application.stop()
+
+    return elapsed
+
+def report(stats: ReplayStats, entries: list, speed: float, elapsed: float):
+    span = entries[-1][0] - entries[0][0] if entries else 0.0
+    processed = len(stats.started)
+    queue_waits = [
+        stats.started[update_id] - arrived
+        for update_id, arrived in stats.arrivals.items() if update_id in stats.started
+    ]
+    latencies = [
+        stats.replied[update_id] - arrived
+        for update_id, arrived in stats.arrivals.items() if update_id in stats.replied
+    ]
+
+    print(f"Обновлений в записи: {len(entries)} за {span:.1f} с (скорость x{speed:g})")
+    print(f"Обработано: {processed}, ответов: {len(stats.replied)}, запросов к LLM: {stats.llm_calls}")
+    print(f"Время воспроизведения: {elapsed:.1f} с, пропускная способность: {processed / elapsed if elapsed else 0:.2f} обн/с")
+    print(f"Максимальная длина очереди: {stats.max_queue_size}")
+    print(f"Ожидание в очереди: {format_distribution(queue_waits)}")
+    print(f"Время до ответа: {format_distribution(latencies)}")
+    print(f"Вызовы Bot API: {json.dumps(stats.api_calls, ensure_ascii=False)}")
+
+    for key in bot_main.llm_pool.snapshot():
+        if key["requests"]:
+            print(
+                f"Ключ {key['name']}: запросов {key['requests']}, 429: {key['rate_limited']}, "
+                f"ошибок {key['failures']}, токенов {key['tokens_total']}"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    parser.add_argument("recording", help="файл, записанный через UPDATE_RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения (1-50)")
+    parser.add_argument("--llm-latency", type=float, default=5.0, help="средняя задержка LLM, секунды")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="разброс задержки LLM (логнормальный)")
+    parser.add_argument("--start", type=float, default=0.0, help="начало окна воспроизведения от начала записи, секунды")
+    parser.add_argument("--duration", type=float, default=None, help="длительность окна воспроизведения, секунды")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="сколько ждать разбора очереди после записи")
+    parser.add_argument("--real-llm", action="store_true", help="запросы через пул ключей LLM_PROVIDERS вместо заглушки")
+    parser.add_argument("--concurrency", type=int, default=bot_main.ANSWER_CONCURRENCY,
+                        help="сколько ответов готовить одновременно (ANSWER_CONCURRENCY)")
+    parser.add_argument("--trace-file", help="записать трассировку каждого обновления (см. tracing.py)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if not 1 <= args.speed <= 50:
+        parser.error("--speed must be between 1 and 50")
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    header, entries = load_recording(args.recording)
+    end = args.start + args.duration if args.duration is not None else float("inf")
+    entries = [(offset - args.start, data) for offset, data in entries if args.start <= offset < end]
+    if not entries:
+        print("Запись пуста")
+        return
+
+    # Отдельная база, чтобы не трогать рабочие счетчики
+    workdir = tempfile.mkdtemp(prefix="leno-replay-")
+    database.DB_FILE = os.path.join(workdir, "replay.db")
+    database.init_db()
+
+    if args.trace_file:
+        tracing.configure(args.trace_file, slow=0.0)
+
+    bot_main.ANSWER_CONCURRENCY = args.concurrency
+    stats = ReplayStats()
+    if not args.real_llm:
+        bot_main.query_chat = make_mock_query_chat(stats, args.llm_latency, args.llm_sigma)
+
+    bot_username = header.get("bot_username") or bot_main.BOT_USERNAME.lstrip("@")
+    elapsed = asyncio.run(replay(entries, bot_username, args.speed, stats, args.drain_timeout))
+    report(stats, entries, args.speed, elapsed)
+
+if __name__ == "__main__":
+    main()
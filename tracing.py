@@ -0,0 +1,244 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import functools
+import contextvars
+from collections import OrderedDict
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+logger = logging.getLogger(__name__)
+
+# Отдельный логгер, который пишет трассировки в JSON-lines файл
+trace_logger = logging.getLogger("traces")
+trace_logger.propagate = False
+
+# Настройки (см. configure)
+enabled = False
+slow_threshold = 10.0
+sample_rate = 0.0
+
+# Текущий span задачи или потока и корень трассировки обработчика
+_current_span = contextvars.ContextVar("current_span", default=None)
+_current_root = contextvars.ContextVar("current_root", default=None)
+
+# Время постановки обновлений в очередь: update_id -> perf_counter.
+# Обновления, которые не дошли до трассируемого обработчика, вытесняются самыми старыми
+_arrivals = OrderedDict()
+MAX_PENDING_ARRIVALS = 10000
+
+class Span:
+    __slots__ = ("name", "start", "end", "children", "discarded")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.discarded = False
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        data = {"name": self.name, "start": round(self.start - origin, 4), "duration": round(self.duration, 4)}
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+# Контекстный менеджер для вложенного участка трассировки
+class _SpanScope:
+    __slots__ = ("span", "token")
+
+    def __init__(self, parent: Span, name: str):
+        self.span = Span(name)
+        parent.children.append(self.span)
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.end = time.perf_counter()
+        _current_span.reset(self.token)
+        return False
+
+class _NullScope:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SCOPE = _NullScope()
+
+def configure(path: str, slow: float = 10.0, rate: float = 0.0,
+              max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+    global enabled, slow_threshold, sample_rate
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+
+    slow_threshold = slow
+    sample_rate = rate
+    enabled = True
+    logger.info(f"Трассировка включена: {path}, медленные от {slow} с, выборка {rate:.0%}")
+
+# Участок трассировки; вне трассируемого обработчика ничего не делает
+def span(name: str):
+    parent = _current_span.get()
+    if parent is None:
+        return _NULL_SCOPE
+    return _SpanScope(parent, name)
+
+# Не записывать трассировку текущего обработчика (например, сообщение не для бота)
+def discard():
+    root = _current_root.get()
+    if root is not None:
+        root.discarded = True
+
+# Запуск функции в пуле потоков с сохранением текущей трассировки
+def run_in_executor(loop: asyncio.AbstractEventLoop, func, *args):
+    if _current_span.get() is None:
+        return loop.run_in_executor(None, func, *args)
+    return loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+# Отметка о поступлении обновления в очередь приложения
+def note_arrival(update_id: int):
+    while len(_arrivals) >= MAX_PENDING_ARRIVALS:
+        _arrivals.popitem(last=False)
+    _arrivals[update_id] = time.perf_counter()
+
+# Очередь обновлений, запоминающая время поступления для фазы "queue"
+class TracingQueue(asyncio.Queue):
+    def put_nowait(self, item):
+        if enabled and hasattr(item, "update_id"):
+            note_arrival(item.update_id)
+        super().put_nowait(item)
+
+# Собственное время каждой фазы (без вложенных участков)
+def phase_breakdown(root: Span) -> dict:
+    phases = {}
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        own = current.duration - sum(child.duration for child in current.children)
+        phases[current.name] = phases.get(current.name, 0.0) + max(own, 0.0)
+        stack.extend(current.children)
+    return {name: round(value, 4) for name, value in phases.items()}
+
+def _finish_trace(root: Span, update, queued: float):
+    if root.discarded:
+        return
+    root.end = time.perf_counter()
+    total = root.duration + queued
+    slow = total >= slow_threshold
+    if not slow and (sample_rate <= 0 or random.random() >= sample_rate):
+        return
+
+    phases = phase_breakdown(root)
+    if queued:
+        phases["queue"] = round(queued, 4)
+
+    message = getattr(update, "effective_message", None)
+    chat = getattr(update, "effective_chat", None)
+    record = {
+        "ts": datetime.utcnow().isoformat(),
+        "handler": root.name,
+        "update_id": getattr(update, "update_id", None),
+        "chat_type": chat.type if chat else None,
+        "text_length": len(message.text) if message and message.text else 0,
+        "total": round(total, 4),
+        "slow": slow,
+        "phases": phases,
+        "spans": root.to_dict(root.start),
+    }
+    try:
+        trace_logger.info(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+    except Exception as e:
+        logger.error(f"Error writing trace: {e}")
+
+# Декоратор обработчика: строит дерево участков для одного обновления
+def traced(callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if not enabled:
+            return await callback(update, context)
+
+        arrived = _arrivals.pop(getattr(update, "update_id", None), None)
+        root = Span(callback.__name__)
+        queued = root.start - arrived if arrived else 0.0
+        token = _current_span.set(root)
+        root_token = _current_root.set(root)
+        try:
+            return await callback(update, context)
+        finally:
+            _current_root.reset(root_token)
+            _current_span.reset(token)
+            _finish_trace(root, update, queued)
+
+    return wrapper
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# Сводка по файлам трассировок: перцентили по фазам
+def summarize(paths: list, handler: str = None, slow_only: bool = False):
+    totals = []
+    phases = {}
+    handlers = {}
+
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if handler and record.get("handler") != handler:
+                    continue
+                if slow_only and not record.get("slow"):
+                    continue
+
+                totals.append(record["total"])
+                handlers[record["handler"]] = handlers.get(record["handler"], 0) + 1
+                for name, value in record["phases"].items():
+                    phases.setdefault(name, []).append(value)
+
+    if not totals:
+        print("Трассировок не найдено")
+        return
+
+    print(f"Трассировок: {len(totals)} ({', '.join(f'{name}: {count}' for name, count in sorted(handlers.items()))})")
+    print(f"{'фаза':<24}{'n':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'доля':>7}")
+    overall = sum(totals)
+    rows = [("total", totals)] + sorted(phases.items(), key=lambda item: -sum(item[1]))
+    for name, values in rows:
+        share = sum(values) / overall if overall else 0.0
+        print(
+            f"{name:<24}{len(values):>7}{percentile(values, 50):>9.3f}{percentile(values, 90):>9.3f}"
+            f"{percentile(values, 99):>9.3f}{max(values):>9.3f}{share:>7.0%}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Сводка по трассировкам обработки сообщений")
+    parser.add_argument("files", nargs="+", help="файлы трассировок (TRACE_FILE и его ротации)")
+    parser.add_argument("--handler", help="только указанный обработчик, например handle_message")
+    parser.add_argument("--slow", action="store_true", help="только медленные трассировки")
+    args = parser.parse_args()
+    summarize(args.files, args.handler, args.slow)
+
+if __name__ == "__main__":
+    main()